@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_webpack.webpack import Webpack, CompileMode, default_work_dir, find_yarn
+from django_webpack.static import compile_ignore_patterns
+
+
+class WebpackCommand(BaseCommand):
+    """options and setup shared by the commands that drive webpack"""
+
+    default_mode = CompileMode.PRODUCTION
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--public-root",
+            type=Path,
+            default=Path(settings.BASE_DIR) / "public",
+            help="Set PUBLIC_ROOT directory",
+        )
+        parser.add_argument(
+            "--mode",
+            type=CompileMode,
+            default=self.default_mode,
+        )
+        parser.add_argument(
+            "--yarn-bin",
+            type=Path,
+            default=None,
+        )
+        parser.add_argument(
+            "--ignore",
+            "-i",
+            action="append",
+            default=[],
+            dest="ignore_patterns",
+            metavar="PATTERN",
+            help=(
+                "Ignore static files and directories whose name matches this "
+                "glob-style pattern, patterns cannot contain a path separator."
+            ),
+        )
+
+    def _resolve_public_root(self, options) -> Path:
+        public_root = os.environ.get("PUBLIC_ROOT", None)
+        if not public_root:
+            public_root = options["public_root"]
+        return Path(public_root)
+
+    def get_webpack(self, options, **kwargs) -> Webpack:
+        yarn_bin = options["yarn_bin"] or find_yarn()
+        if not yarn_bin:
+            raise CommandError("yarn binary not found.")
+
+        try:
+            compile_ignore_patterns(options["ignore_patterns"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        return Webpack(
+            yarn_bin,
+            default_work_dir(options["mode"]),
+            document_root=self._resolve_public_root(options),
+            mode=options["mode"],
+            ignore_patterns=options["ignore_patterns"],
+            **kwargs,
+        )
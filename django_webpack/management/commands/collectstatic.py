@@ -1,55 +1,37 @@
-import os
-import shutil
-import tempfile
-from pathlib import Path
+import asyncio
 
-from django.conf import settings
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 
-from django_webpack.webpack import Webpack, CompileMode
+from ._base import WebpackCommand
 
 
-class Command(BaseCommand):
+class Command(WebpackCommand):
     help = "Collect all static files and run webpack"
+    # only hand the process over to webpack when run from the command line,
+    # call_command() callers expect to get control back
+    exec_build = False
 
     def add_arguments(self, parser):
-        parser.add_argument(
-            "--public-root",
-            type=Path,
-            default=Path(settings.BASE_DIR) / "public",
-            help="Set PUBLIC_ROOT directory",
-        )
-        parser.add_argument(
-            "--mode",
-            type=CompileMode,
-            default=CompileMode.PRODUCTION,
-        )
-        parser.add_argument(
-            "--yarn-bin",
-            type=Path,
-            default=shutil.which("yarn"),
-        )
+        super().add_arguments(parser)
         parser.add_argument(
             "--watch",
             action="store_true",
             default=False,
         )
 
+    def run_from_argv(self, argv):
+        self.exec_build = True
+        super().run_from_argv(argv)
+
     def handle(self, *args, **options):
-        yarn_bin = options["yarn_bin"]
-        if not yarn_bin:
-            raise CommandError("yarn binary not found.")
-
-        with tempfile.TemporaryDirectory() as work_dir:
-            public_root = os.environ.get("PUBLIC_ROOT", None)
-            if not public_root:
-                public_root = options["public_root"]
-
-            wp = Webpack(
-                yarn_bin,
-                Path(work_dir),
-                document_root=Path(public_root),
-                mode=options["mode"],
-            )
-            wp.prepare_webpack_root()
-            wp.run_webpack_build(watch=options["watch"])
+        wp = self.get_webpack(options)
+        wp.prepare_webpack_root()
+        if self.exec_build and not options["watch"]:
+            result = wp.exec_webpack_build()
+        else:
+            result = asyncio.run(wp.run_webpack_build(watch=options["watch"]))
+
+        if result is None:
+            self.stdout.write("webpack build is up to date")
+        elif result[1] != 0:
+            raise CommandError("webpack exited with status %d" % result[1])
@@ -2,11 +2,9 @@ import json
 import os
 import sys
 from enum import Enum
-from pathlib import Path
 
-from django.contrib.staticfiles.finders import get_finders
-from django.core.management.base import BaseCommand, CommandError
-from django_webpack.static import get_staticfiles
+from django.core.management.base import BaseCommand
+from django_webpack.static import iter_staticfiles
 
 
 class OutputFormat(Enum):
@@ -21,11 +19,16 @@ class Command(BaseCommand):
         parser.add_argument("--format", type=OutputFormat, default=OutputFormat.JSON)
 
     def handle(self, *args, **options):
-        found_files = get_staticfiles()
         format = options.get("format")
         if format == OutputFormat.JSON:
-            json.dump(found_files, sys.stdout, indent=2)
+            sys.stdout.write("{")
+            sep = "\n"
+            for k, (p, f) in iter_staticfiles():
+                sys.stdout.write(sep)
+                sys.stdout.write(f"  {json.dumps(k)}: {json.dumps([p, f])}")
+                sep = ",\n"
+            sys.stdout.write("\n}\n")
         else:
-            for k, (p, f) in found_files.items():
-                sys.stdout.write(str(Path(p) / f))
+            for k, (p, f) in iter_staticfiles():
+                sys.stdout.write(os.path.join(p, f))
                 sys.stdout.write("\n")
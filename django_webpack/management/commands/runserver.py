@@ -1,39 +1,65 @@
-import re
 import os
-import shutil
+import multiprocessing
 import socket
-import tempfile
 import uvicorn
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import watchfiles
 from pathlib import Path
 from importlib import import_module
 
 from django.apps import apps
 from django.conf import settings
-from django.core.management.base import BaseCommand, CommandError
-from django.utils.regex_helper import _lazy_re_compile
+from django.core.management.base import CommandError
 
 from django_webpack.webpack import Webpack, CompileMode
 
-naiveip_re = _lazy_re_compile(
-    r"""^(?:
-(?P<addr>
-    (?P<ipv4>\d{1,3}(?:\.\d{1,3}){3}) |         # IPv4 address
-    (?P<ipv6>\[[a-fA-F0-9:]+\]) |               # IPv6 address
-    (?P<fqdn>[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*) # FQDN
-):)?(?P<port>\d+)$""",
-    re.X,
-)
+from ._base import WebpackCommand
 
 
-class Command(BaseCommand):
+def _is_digits(s: str) -> bool:
+    # isdigit() alone also accepts e.g. superscripts
+    return s.isascii() and s.isdigit()
+
+
+def _is_fqdn(s: str) -> bool:
+    """dot separated labels of ASCII letters, digits and hyphens"""
+    return all(
+        label.isascii() and label.replace("-", "a").isalnum() for label in s.split(".")
+    )
+
+
+def parse_addrport(addrport: str):
+    """split "port", "addr:port" or "[ipv6]:port" into (addr, port, kind) where
+    kind is "ipv4", "ipv6", "fqdn" or None if no address was given. returns None
+    if addrport is malformed."""
+    addr, sep, port = addrport.rpartition(":")
+    if not _is_digits(port) or (sep and not addr):
+        return None
+    if not addr:
+        return "", port, None
+    if addr.startswith("[") and addr.endswith("]"):
+        try:
+            socket.inet_pton(socket.AF_INET6, addr[1:-1])
+        except (OSError, ValueError):
+            return None
+        return addr, port, "ipv6"
+    parts = addr.split(".")
+    if len(parts) == 4 and all(_is_digits(p) and len(p) <= 3 for p in parts):
+        return addr, port, "ipv4"
+    if _is_fqdn(addr):
+        return addr, port, "fqdn"
+    return None
+
+
+class Command(WebpackCommand):
     help = "Starts a lightweight web server for development."
+    default_mode = CompileMode.DEVELOPMENT
     default_addr = "127.0.0.1"
     default_addr_ipv6 = "::1"
     default_port = "8000"
 
     def add_arguments(self, parser):
+        super().add_arguments(parser)
         parser.add_argument(
             "addrport", nargs="?", help="Optional port number, or ipaddr:port"
         )
@@ -45,21 +71,67 @@ class Command(BaseCommand):
             help="Tells Django to use an IPv6 address.",
         )
         parser.add_argument(
-            "--public-root",
-            type=Path,
-            default=Path(settings.BASE_DIR) / "public",
-            help="Set PUBLIC_ROOT directory",
+            "--watch-aggregate-ms",
+            type=int,
+            default=300,
+            help="Delay before webpack rebuilds after the first change",
         )
         parser.add_argument(
-            "--mode",
-            type=CompileMode,
-            default=CompileMode.DEVELOPMENT,
+            "--watch-poll",
+            type=int,
+            metavar="MS",
+            default=None,
+            help="Make webpack poll for changes every MS milliseconds",
         )
-        parser.add_argument(
-            "--yarn-bin",
-            type=Path,
-            default=shutil.which("yarn"),
+
+    async def watch_webpack(self, wp: Webpack):
+        """prepare the work dir and run webpack in watch mode
+
+        CopyPlugin registers the copied static directories with webpack's own
+        watcher, so files added, changed or removed in them are picked up and
+        bursts of changes are collapsed by watchOptions.aggregateTimeout
+        (--watch-aggregate-ms). a new static directory, e.g. from a newly
+        installed app, needs a restart like any settings change.
+        """
+        await asyncio.to_thread(wp.prepare_webpack_root)
+        return await wp.run_webpack_build(watch=True)
+
+    async def serve(self, wp: Webpack, reload_dirs):
+        """serve the asgi app in a subprocess that is restarted on source
+        changes, alongside the webpack watcher
+
+        watchfiles handles SIGINT itself and just returns, and webpack runs in
+        its own session, so whichever side finishes first stops the other.
+        """
+        server = asyncio.create_task(
+            watchfiles.arun_process(
+                *reload_dirs,
+                target=uvicorn.run,
+                watch_filter=watchfiles.PythonFilter(),
+                kwargs=dict(
+                    app="django_webpack.asgi:app",
+                    host=self.addr,
+                    port=int(self.port),
+                ),
+            )
         )
+        webpack = asyncio.create_task(self.watch_webpack(wp))
+        await asyncio.wait([server, webpack], return_when=asyncio.FIRST_COMPLETED)
+
+        if not webpack.done():
+            webpack.cancel()
+            await asyncio.gather(webpack, return_exceptions=True)
+            server.result()
+            return
+
+        # a cancelled arun_process leaves the server process running
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+        for process in multiprocessing.active_children():
+            process.terminate()
+            process.join()
+        _, rc = webpack.result()
+        raise CommandError("webpack exited with status %d" % rc)
 
     def handle(self, *args, **options):
         reload_dirs = [Path(settings.BASE_DIR).resolve()]
@@ -78,56 +150,31 @@ class Command(BaseCommand):
             self.addr = ""
             self.port = self.default_port
         else:
-            m = re.match(naiveip_re, options["addrport"])
-            if m is None:
+            parsed = parse_addrport(options["addrport"])
+            if parsed is None:
                 raise CommandError(
                     '"%s" is not a valid port number '
                     "or address:port pair." % options["addrport"]
                 )
-            self.addr, _ipv4, _ipv6, _fqdn, self.port = m.groups()
-            if not self.port.isdigit():
-                raise CommandError("%r is not a valid port number." % self.port)
+            self.addr, self.port, kind = parsed
             if self.addr:
-                if _ipv6:
+                if kind == "ipv6":
                     self.addr = self.addr[1:-1]
                     self.use_ipv6 = True
                     self._raw_ipv6 = True
-                elif self.use_ipv6 and not _fqdn:
+                elif self.use_ipv6 and kind != "fqdn":
                     raise CommandError('"%s" is not a valid IPv6 address.' % self.addr)
         if not self.addr:
             self.addr = self.default_addr_ipv6 if self.use_ipv6 else self.default_addr
             self._raw_ipv6 = self.use_ipv6
 
-        yarn_bin = options["yarn_bin"]
-        if not yarn_bin:
-            raise CommandError("yarn binary not found.")
-
-        with tempfile.TemporaryDirectory() as work_dir:
-            public_root = os.environ.get("PUBLIC_ROOT", None)
-            if not public_root:
-                public_root = options["public_root"]
-
-            wp = Webpack(
-                yarn_bin,
-                Path(work_dir),
-                document_root=Path(public_root),
-                mode=options["mode"],
-            )
-
-            def run_webpack():
-                # TODO detect updated staticfiles list
-                wp.prepare_webpack_root()
-                wp.run_webpack_build(watch=True)
-
-            loop = asyncio.get_event_loop()
-            executor = ThreadPoolExecutor(1)
-            loop.run_in_executor(executor, run_webpack)
-            os.environ.setdefault("PUBLIC_ROOT", str(public_root))
-            uvicorn.run(
-                "django_webpack.asgi:app",
-                host=self.addr,
-                port=int(self.port),
-                reload=True,
-                reload_dirs=reload_dirs,
-            )
-            loop.close()
+        wp = self.get_webpack(
+            options,
+            watch_poll=options["watch_poll"],
+            watch_aggregate_ms=options["watch_aggregate_ms"],
+        )
+        os.environ.setdefault("PUBLIC_ROOT", str(wp.document_root))
+        try:
+            asyncio.run(self.serve(wp, reload_dirs))
+        except KeyboardInterrupt:
+            pass
@@ -1,9 +1,22 @@
+import os
+import stat
+import mimetypes
 from pathlib import Path
 from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponseNotModified
 from django.http.request import HttpRequest
-from django.views.static import serve
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.static import was_modified_since
 
-from .webpack import staticfiles_matcher, staticfiles_prefix
+from .webpack import staticfiles_prefix
+
+_STATIC_URL = settings.STATIC_URL
+_DOC_ROOT = Path(settings.PUBLIC_ROOT) / staticfiles_prefix
+
+# load the mime type tables now rather than on the first static request
+mimetypes.init()
 
 
 class WebpackStaticMiddleware:
@@ -11,13 +24,35 @@ class WebpackStaticMiddleware:
         self.get_response = get_response
 
     def __call__(self, request: HttpRequest):
-        static_file = staticfiles_matcher.findall(request.path)
-        if static_file:
-            return serve(
-                request,
-                static_file[0],
-                document_root=Path(settings.PUBLIC_ROOT) / staticfiles_prefix,
-                show_indexes=True,
-            )
+        path = request.path
+        if path.startswith(_STATIC_URL):
+            response = self.serve(request, path[len(_STATIC_URL) :])
+            if response:
+                return response
 
         return self.get_response(request)
+
+    def serve(self, request: HttpRequest, path: str):
+        """stream the file from the document root, None if there is no such file"""
+        try:
+            fullpath = safe_join(_DOC_ROOT, path)
+            statobj = os.stat(fullpath)
+        except (SuspiciousFileOperation, OSError, ValueError):
+            return None
+        if not stat.S_ISREG(statobj.st_mode):
+            return None
+
+        if not was_modified_since(
+            request.META.get("HTTP_IF_MODIFIED_SINCE"), statobj.st_mtime
+        ):
+            return HttpResponseNotModified()
+
+        content_type, encoding = mimetypes.guess_type(fullpath)
+        response = FileResponse(
+            open(fullpath, "rb"),
+            content_type=content_type or "application/octet-stream",
+        )
+        response.headers["Last-Modified"] = http_date(statobj.st_mtime)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,51 @@
+import os
+import re
+import fnmatch
+from typing import Iterator, List, Optional, Pattern, Tuple
+
+from django.contrib.staticfiles.finders import get_finders
+
+
+def list_finder(finder, ignore_patterns: List = []) -> Iterator[Tuple[str, str, str]]:
+    """yield (prefixed_path, location, path) for every file the finder knows"""
+    for path, storage in finder.list(ignore_patterns):
+        if getattr(storage, "prefix", None):
+            prefixed_path = os.path.join(storage.prefix, path)
+        else:
+            prefixed_path = path
+        yield prefixed_path, storage.location, path
+
+
+def iter_staticfiles(
+    ignore_patterns: List = [],
+) -> Iterator[Tuple[str, Tuple[str, str]]]:
+    """yield (prefixed_path, (location, path)) for each static file, the first
+    finder to provide a path wins like in django's collectstatic"""
+    seen = set()
+    for finder in get_finders():
+        for prefixed_path, location, path in list_finder(finder, ignore_patterns):
+            if prefixed_path not in seen:
+                seen.add(prefixed_path)
+                yield prefixed_path, (location, path)
+
+
+def compile_ignore_patterns(ignore_patterns: List) -> Optional[Pattern]:
+    """fold glob-style ignore patterns into one regex, None if there are none
+
+    patterns are matched against single file and directory names, the only
+    form the CopyPlugin globs in the webpack config agree on, so patterns
+    containing a "/" are rejected with ValueError.
+    """
+    if not ignore_patterns:
+        return None
+    for p in ignore_patterns:
+        if "/" in p or os.sep in p:
+            raise ValueError(f"ignore pattern {p!r} must not contain a path separator")
+    return re.compile("|".join(fnmatch.translate(p) for p in ignore_patterns))
+
+
+def is_ignored(ignore_re: Optional[Pattern], path: str) -> bool:
+    """whether the name of the file or of any directory it is in matches"""
+    if ignore_re is None:
+        return False
+    return any(ignore_re.match(part) for part in path.split(os.sep))
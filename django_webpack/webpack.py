@@ -1,16 +1,25 @@
 import os
 import re
 import enum
+import json
 import sys
+import pickle
+import hashlib
+import signal
+import time
+import shutil
 import asyncio
+import functools
 import posixpath
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Tuple
 
 from django.conf import settings
 from django.contrib.staticfiles.finders import get_finders
-from jinja2 import Template
+
+from .static import compile_ignore_patterns, is_ignored, list_finder
 
 
 class CompileMode(enum.Enum):
@@ -45,11 +54,24 @@ module.exports = {
     filename: "[name].js",
     clean: true,
   },
+  cache: {
+    type: "filesystem",
+    cacheDirectory: path.resolve("{{ cache_dir }}"),
+    buildDependencies: { config: [__filename] },
+  },
+  snapshot: {
+    managedPaths: [path.resolve("{{ node_modules }}")],
+  },
+  watchOptions: {
+    aggregateTimeout: {{ watch_aggregate_ms }},
+    poll: {{ watch_poll }},
+    ignored: ["**/node_modules", "**/.git"],
+  },
   plugins: [
     new CopyPlugin({
       patterns: [
 {%- for cf in copy_files %}
-        { from: "{{ cf.source }}", to: "{{ cf.dest }}" },
+        { from: "{{ cf.source }}", to: "{{ cf.dest }}", toType: "{{ cf.to_type }}", globOptions: { dot: true, ignore: {{ cf.ignore }} } },
 {%- endfor %}
       ],
     }),
@@ -85,48 +107,97 @@ module.exports = {
 };
 """
 
-BASE_DIR = Path(__file__).parent.parent.resolve()
-
-staticfiles_matcher = re.compile(r"^%s(?P<path>.*)$" % settings.STATIC_URL)
-staticfiles_prefix = posixpath.normpath(Path(settings.STATIC_URL).resolve()).lstrip("/")
+# the default template is rendered without jinja2. "{%-" strips the whitespace
+# before the tag and jinja drops the trailing newline, the output is identical
+_config_head, _config_rest = WEBPACK_CONFIG_TEMPLATE.split(
+    "{%- for cf in copy_files %}"
+)
+_copy_pattern, _config_tail = _config_rest.split("{%- endfor %}")
+_config_head, _copy_pattern = _config_head.rstrip(), _copy_pattern.rstrip()
+_config_tail = _config_tail.removesuffix("\n")
+_placeholder = re.compile(r"\{\{ (?:cf\.)?(\w+) \}\}")
 
 
-async def _read_stream(stream, cb):
-    while True:
-        line = await stream.readline()
-        if line:
-            cb(line)
-        else:
-            break
+def _substitute(template: str, values: dict) -> str:
+    return _placeholder.sub(lambda m: str(values[m.group(1)]), template)
 
 
-async def _stream_subprocess(cmd, stdout_cb, stderr_cb):
-    try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+def _render_default_config(context: dict) -> str:
+    return (
+        _substitute(_config_head, context)
+        + "".join(
+            _substitute(_copy_pattern, {**context, **cf})
+            for cf in context["copy_files"]
         )
+        + _substitute(_config_tail, context)
+    )
 
-        await asyncio.wait(
-            [
-                _read_stream(process.stdout, stdout_cb),
-                _read_stream(process.stderr, stderr_cb),
-            ]
-        )
+
+BASE_DIR = Path(__file__).parent.parent.resolve()
+STATICFILES_CACHE = ".staticfiles.cache"
+INSTALL_STAMP = ".django-webpack.installstamp"
+INPUTS_HASH = ".django-webpack.inputs-hash"
+
+staticfiles_prefix = posixpath.normpath(settings.STATIC_URL).strip("/")
+
+
+def _kill(process):
+    try:
+        if hasattr(os, "killpg"):
+            # yarn does not pass signals on to the node process it spawns
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def _run_subprocess(cmd, cwd=None):
+    """run cmd on the inherited stdio, returns (pid, returncode) and kills the
+    whole process group if cancelled"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=cwd,
+        start_new_session=True,
+    )
+    try:
         rc = await process.wait()
         return process.pid, rc
-    except OSError as e:
-        # the program will hang if we let any exception propagate
-        return e
+    finally:
+        if process.returncode is None:
+            _kill(process)
+            await process.wait()
 
 
-def execute(*aws):
-    """run the given coroutines in an asyncio loop
-    returns a list containing the values returned from each coroutine.
-    """
-    loop = asyncio.get_event_loop()
-    rc = loop.run_until_complete(asyncio.gather(*aws))
-    loop.close()
-    return rc
+@functools.cache
+def find_yarn():
+    return shutil.which("yarn")
+
+
+def default_work_dir(mode: CompileMode) -> Path:
+    """per-project and per-mode scaffold directory under the user's cache
+    directory, so a production collectstatic does not clobber the config and
+    build record of a running development watcher"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    project = hashlib.sha1(str(settings.BASE_DIR).encode()).hexdigest()[:12]
+    return Path(cache_home) / "django-webpack" / project / mode.value
+
+
+def _symlink(src: Path, dst: Path):
+    """point dst at src, replacing whatever is there unless it already does"""
+    if dst.is_symlink():
+        if os.readlink(dst) == str(src):
+            return
+        dst.unlink()
+    elif dst.is_dir():
+        # e.g. node_modules that yarn installed into the work dir while the
+        # project did not have its own
+        shutil.rmtree(dst)
+    elif dst.exists():
+        dst.unlink()
+    os.symlink(src, dst, target_is_directory=src.is_dir())
 
 
 def printer(label):
@@ -136,11 +207,48 @@ def printer(label):
     return pr
 
 
-def name_it(start=0, template="s{}"):
-    """a simple generator for task names"""
-    while True:
-        yield template.format(start)
-        start += 1
+def _glob_escape(path: str) -> str:
+    """escape the characters fast-glob would read as pattern syntax"""
+    return re.sub(r"([()*?\[\]{|}]|^!|[!+@](?=\())", r"\\\1", path)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _finder_storages(finder) -> List[Tuple[str, str]]:
+    """(prefix, location) of the finder's storages, empty if it has none"""
+    storages = getattr(finder, "storages", None)
+    if not storages:
+        return []
+    return [
+        (getattr(storage, "prefix", None), storage.location)
+        for storage in storages.values()
+    ]
+
+
+def _snapshot_dirs(roots: List[str]) -> Tuple[Tuple[str, int], ...]:
+    """mtimes of every directory below the given roots
+
+    adding, removing or renaming a file bumps its parent directory's mtime, so
+    re-stating these directories is enough to tell whether a listing is stale.
+    symlinked directories are followed like FileSystemStorage.listdir does.
+    """
+    snapshot = []
+    for root in roots:
+        snapshot.append((root, _mtime(root)))
+        for dirpath, dirnames, _ in os.walk(root, followlinks=True):
+            for dirname in dirnames:
+                path = os.path.join(dirpath, dirname)
+                snapshot.append((path, _mtime(path)))
+    return tuple(snapshot)
+
+
+def _snapshot_is_fresh(snapshot: Tuple[Tuple[str, int], ...]) -> bool:
+    return all(_mtime(path) == mtime for path, mtime in snapshot)
 
 
 class Webpack:
@@ -152,8 +260,15 @@ class Webpack:
         mode: CompileMode = CompileMode.PRODUCTION,
         config: str = WEBPACK_CONFIG_TEMPLATE,
         extra_context: dict = {},
+        watch_poll: int = None,
+        watch_aggregate_ms: int = 300,
+        ignore_patterns: List = [],
     ):
         self.mode = mode
+        self.ignore_patterns = list(ignore_patterns)
+        self._ignore_re = compile_ignore_patterns(self.ignore_patterns)
+        self.watch_poll = watch_poll
+        self.watch_aggregate_ms = watch_aggregate_ms
         self.config = config
         self.extra_context = extra_context
         self.work_dir = work_dir
@@ -170,52 +285,204 @@ class Webpack:
         app_node_modules = Path(settings.BASE_DIR) / "node_modules"
         self.node_modules_path = app_node_modules if app_node_modules.exists() else None
         self.webpack_config_file = self.work_dir / "webpack.config.js"
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.staticfiles_cache_file = self.work_dir / STATICFILES_CACHE
+        # the record lives next to the output it describes, so a build in any
+        # other mode or work dir that replaces the output also drops it
+        self.inputs_hash_file = self.document_root / INPUTS_HASH
+        self.pending_inputs_file = self.work_dir / f"{INPUTS_HASH}.pending"
+        self._staticfiles_cache = self._load_staticfiles_cache()
+        self._staticfiles_cache_dirty = False
+
+    def _load_staticfiles_cache(self) -> dict:
+        try:
+            with open(self.staticfiles_cache_file, "rb") as fp:
+                cache = pickle.load(fp)
+        except Exception:
+            # missing, truncated or written by an incompatible version
+            return {}
+
+        if not isinstance(cache, dict) or not all(
+            isinstance(v, tuple) and len(v) == 3 for v in cache.values()
+        ):
+            return {}
+        return cache
+
+    def _save_staticfiles_cache(self):
+        try:
+            with open(self.staticfiles_cache_file, "wb") as fp:
+                pickle.dump(self._staticfiles_cache, fp)
+        except OSError:
+            pass
+
+    def _list_finder(self, finder) -> List[Tuple[str, str, str]]:
+        """list all of a finder's files, reusing the previous listing if none
+        of its directories changed since. ignore patterns are applied later so
+        the listing can be cached regardless of them."""
+        # the prefixes end up in the listed paths, so they are part of the key
+        storages = _finder_storages(finder)
+        key = (type(finder).__module__, type(finder).__qualname__)
+        cached = self._staticfiles_cache.get(key)
+        if (
+            storages
+            and cached
+            and cached[0] == storages
+            and _snapshot_is_fresh(cached[1])
+        ):
+            return cached[2]
+
+        snapshot = _snapshot_dirs([location for _, location in storages])
+        files = list(list_finder(finder))
+
+        if storages:
+            self._staticfiles_cache[key] = (storages, snapshot, files)
+            self._staticfiles_cache_dirty = True
+        return files
 
     def get_staticfiles(self, ignore_patterns: List = []) -> Dict[str, Tuple[str, str]]:
-        found_files = {}
-        for finder in get_finders():
-            for path, storage in finder.list(ignore_patterns):
-                if getattr(storage, "prefix", None):
-                    prefixed_path = os.path.join(storage.prefix, path)
-                else:
-                    prefixed_path = path
+        ignore_re = self._ignore_re
+        if ignore_patterns:
+            ignore_re = compile_ignore_patterns(self.ignore_patterns + ignore_patterns)
 
+        # finders walk independent directory trees, list them concurrently and
+        # merge in finder order so the first finder still wins
+        finders = list(get_finders())
+        with ThreadPoolExecutor(max_workers=min(8, len(finders) or 1)) as executor:
+            listings = list(executor.map(self._list_finder, finders))
+
+        found_files = {}
+        for files in listings:
+            for prefixed_path, location, path in files:
+                if is_ignored(ignore_re, path):
+                    continue
                 if prefixed_path not in found_files:
-                    found_files[prefixed_path] = (storage.location, path)
+                    found_files[prefixed_path] = (location, path)
 
+        if self._staticfiles_cache_dirty:
+            self._save_staticfiles_cache()
+            self._staticfiles_cache_dirty = False
         return found_files
 
-    def prepare_webpack_root(self):
-        static_files = self.get_staticfiles()
-
+    def _ignore_globs(self, location: str) -> str:
+        """the ignore patterns as globOptions.ignore for a directory pattern
+
+        fast-glob matches them against absolute paths, so they are anchored to
+        the directory to leave the names of its parents alone, like is_ignored
+        """
+        root = _glob_escape(Path(location).as_posix())
+        globs = []
+        for p in self.ignore_patterns:
+            # the file itself or anything below a directory of that name
+            globs += [f"{root}/**/{p}", f"{root}/**/{p}/**"]
+        return json.dumps(globs)
+
+    def get_copy_patterns(self) -> List[dict]:
+        """CopyPlugin patterns for the static files, one per storage directory
+        so the generated config does not grow with the number of files"""
         copy_files = []
-        for k, v in static_files.items():
-            copy_files.append(
-                dict(
-                    source=Path(v[0]) / v[1],
-                    dest=Path(staticfiles_prefix) / k,
+        for finder in get_finders():
+            storages = getattr(finder, "storages", None)
+            if not storages:
+                for prefixed_path, location, path in self._list_finder(finder):
+                    if is_ignored(self._ignore_re, path):
+                        continue
+                    copy_files.append(
+                        dict(
+                            source=os.path.join(location, path),
+                            dest=posixpath.join(staticfiles_prefix, prefixed_path),
+                            to_type="file",
+                            ignore="[]",
+                        )
+                    )
+                continue
+
+            for storage in storages.values():
+                if not os.path.isdir(storage.location):
+                    continue
+                prefix = getattr(storage, "prefix", None) or ""
+                copy_files.append(
+                    dict(
+                        source=storage.location,
+                        dest=posixpath.join(staticfiles_prefix, prefix),
+                        to_type="dir",
+                        ignore=self._ignore_globs(storage.location),
+                    )
                 )
-            )
 
-        webpack_config = Template(self.config)
+        return copy_files
+
+    def write_webpack_config(self) -> bool:
+        """render the webpack config, returns False if it did not change"""
+        copy_files = self.get_copy_patterns()
+
         context = dict(
             mode=self.mode.value,
             public_path=f".{os.path.sep}",
             copy_files=copy_files,
+            cache_dir=self.work_dir / ".webpack-cache",
+            # node_modules is usually a symlink, webpack snapshots the real path
+            node_modules=(self.work_dir / "node_modules").resolve(),
+            watch_aggregate_ms=self.watch_aggregate_ms,
+            watch_poll=self.watch_poll if self.watch_poll else "false",
         )
 
-        context.update(self.extra_context)
-        with open(self.webpack_config_file, "w") as cf:
-            cf.write(webpack_config.render(**context))
+        if self.config == WEBPACK_CONFIG_TEMPLATE and not self.extra_context:
+            rendered = _render_default_config(context)
+        else:
+            from jinja2 import Template
 
-        os.symlink(self.package_json_path, self.work_dir / "package.json")
-        os.symlink(self.yarn_lock_path, self.work_dir / "yarn.lock")
-        if self.node_modules_path:
-            os.symlink(self.node_modules_path, self.work_dir / "node_modules")
+            context.update(self.extra_context)
+            rendered = Template(self.config).render(**context)
+        try:
+            if self.webpack_config_file.read_text() == rendered:
+                return False
+        except OSError:
+            pass
 
-        subprocess.run([self.yarn_bin], cwd=self.work_dir)
+        # rewriting an unchanged config would invalidate webpack's cache
+        with open(self.webpack_config_file, "w") as cf:
+            cf.write(rendered)
+        return True
 
-    def run_webpack_build(self, watch: bool = False):
+    def prepare_webpack_root(self):
+        _symlink(self.package_json_path, self.work_dir / "package.json")
+        _symlink(self.yarn_lock_path, self.work_dir / "yarn.lock")
+        node_modules = self.work_dir / "node_modules"
+        if self.node_modules_path:
+            _symlink(self.node_modules_path, node_modules)
+        elif node_modules.is_symlink():
+            # the project's node_modules is gone, let yarn install into the
+            # work dir instead of following a dangling link
+            node_modules.unlink()
+
+        self.write_webpack_config()
+        self.install_dependencies()
+
+    def _install_digest(self) -> str:
+        digest = hashlib.sha256()
+        for path in (self.package_json_path, self.yarn_lock_path):
+            with open(path, "rb") as fp:
+                digest.update(fp.read())
+        return digest.hexdigest()
+
+    def install_dependencies(self):
+        """run yarn unless node_modules was already installed from the same
+        package.json and yarn.lock"""
+        stamp = self.work_dir / "node_modules" / INSTALL_STAMP
+        digest = self._install_digest()
+        try:
+            if stamp.read_text() == digest:
+                return
+        except OSError:
+            pass
+
+        if subprocess.run([self.yarn_bin], cwd=self.work_dir).returncode == 0:
+            try:
+                stamp.write_text(digest)
+            except OSError:
+                pass
+
+    def webpack_build_command(self, watch: bool = False) -> List:
         cmd = [
             self.yarn_bin,
             "webpack",
@@ -226,4 +493,86 @@ class Webpack:
         ]
         if watch:
             cmd.append("--watch")
-        subprocess.run(cmd, cwd=self.work_dir)
+        return cmd
+
+    def _inputs_digest(self, static_files: Dict[str, Tuple[str, str]]) -> str:
+        digest = hashlib.blake2b(self.webpack_config_file.read_bytes())
+        digest.update(json.dumps(sorted(static_files.items())).encode())
+        digest.update(self.mode.value.encode())
+        digest.update(str(self.document_root).encode())
+        return digest.hexdigest()
+
+    def _is_up_to_date(
+        self, digest: str, static_files: Dict[str, Tuple[str, str]]
+    ) -> bool:
+        """whether the last successful build ran with the same inputs and no
+        source was modified after it started"""
+        try:
+            recorded, started = self.inputs_hash_file.read_text().split()
+            started = int(started)
+        except (OSError, ValueError):
+            return False
+        if recorded != digest:
+            return False
+        if not (self.document_root / "manifest.json").exists():
+            return False
+
+        sources = [self.package_json_path, self.yarn_lock_path]
+        sources.extend(os.path.join(*v) for v in static_files.values())
+        return all((_mtime(p) or 0) <= started for p in sources)
+
+    def _prepare_build(self, watch: bool) -> bool:
+        """returns False if a one-off build can be skipped
+
+        otherwise the record of the current output is dropped and a new one is
+        staged in the work dir, to be moved into place only if webpack
+        succeeds. watch builds never finish, so they never leave a record.
+        """
+        if not watch:
+            static_files = self.get_staticfiles()
+            digest = self._inputs_digest(static_files)
+            if self._is_up_to_date(digest, static_files):
+                return False
+
+        started = time.time_ns()
+        self.inputs_hash_file.unlink(missing_ok=True)
+        if not watch:
+            self.pending_inputs_file.write_text(f"{digest} {started}")
+        return True
+
+    def exec_webpack_build(self):
+        """replace the current process with a one-off webpack build, returns
+        None without building if the last build is up to date"""
+        if not self._prepare_build(watch=False):
+            return None
+
+        cmd = [str(arg) for arg in self.webpack_build_command()]
+        if os.name == "posix":
+            # python is gone once webpack runs, a shell commits the record
+            cmd = [
+                "sh",
+                "-c",
+                'pending=$1 record=$2; shift 2; "$@" && mv -f "$pending" "$record"',
+                "sh",
+                str(self.pending_inputs_file),
+                str(self.inputs_hash_file),
+                *cmd,
+            ]
+        os.chdir(self.work_dir)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execvp(cmd[0], cmd)
+
+    async def run_webpack_build(self, watch: bool = False):
+        """run webpack, returns (pid, returncode) or None if a one-off build
+        was skipped because the last one is up to date"""
+        if not self._prepare_build(watch):
+            return None
+
+        pid, rc = await _run_subprocess(
+            self.webpack_build_command(watch), cwd=self.work_dir
+        )
+        if not watch and rc == 0:
+            # the work dir and the output can be on different filesystems
+            shutil.move(self.pending_inputs_file, self.inputs_hash_file)
+        return pid, rc